@@ -7,9 +7,10 @@ import time
 import asyncio
 import atexit
 import threading
+from typing import Optional
 from flask import Flask, request, jsonify
 from api import config
-from api.services import lark_service, openai_service, redis_service
+from api.services import lark_service, openai_service, redis_service, memory_service, media_service
 from api.services.mcp_service import mcp_manager
 from api.commands import handler as command_handler
 
@@ -107,8 +108,11 @@ def lark_callback():
 
     msg_id = message.get("message_id")
     chat_id = message.get("chat_id")
+    scope = lark_service.get_context_scope(message, sender)
+    chat_type = message.get("chat_type")
+    thread_root_id = lark_service.get_thread_root_id(message) if chat_type == "group" and config.GROUP_CONTEXT_BY_THREAD else None
     
-    log_context.update({"chat_id": chat_id, "msg_id": msg_id})
+    log_context.update({"chat_id": chat_id, "msg_id": msg_id, "scope": scope})
 
     if not msg_id or redis_service.is_message_processed(msg_id):
         logger.info("Duplicate message ignored.", extra=log_context)
@@ -125,17 +129,17 @@ def lark_callback():
             logger.warning(f"Ignoring stale message (age: {age_seconds:.0f}s).", extra=log_context)
             return jsonify({"msg": "Stale message ignored"})
 
-    text_content = json.loads(message.get("content", "{}")).get("text", "").strip()
+    text_content, resources = lark_service.parse_message_content(message)
     mentions = message.get("mentions", [])
     text_content = lark_service.resolve_mentions(text_content, mentions)
     
     if text_content.startswith('/'):
         parts = text_content.split()
         logger.info("Handling command '%s' for chat.", parts[0], extra=log_context)
-        command_handler.handle_command(parts[0], parts[1:], chat_id)
+        command_handler.handle_command(parts[0], parts[1:], chat_id, scope, reply_to=msg_id if thread_root_id else None)
         return jsonify({"msg": "Command handled"})
     
-    if not text_content:
+    if not text_content and not resources:
         logger.info("Empty message content received.", extra=log_context)
         return jsonify({"msg": "Empty message content"})
 
@@ -144,7 +148,6 @@ def lark_callback():
     logger.info("Starting synchronous processing for Vercel.", extra=log_context)
 
     # For group chats, respond only when mentioned. For P2P chats, respond to any message.
-    chat_type = message.get("chat_type")
     if chat_type == "group":
         # Lazy-load the bot's Open ID if it hasn't been fetched yet.
         # This is thread-safe and avoids race conditions in multi-worker setups.
@@ -164,9 +167,17 @@ def lark_callback():
             logger.info("Bot not mentioned in group chat, ignoring message.", extra=log_context)
             return jsonify({"msg": "Bot not mentioned"})
 
+    # With thread scoping, group messages are answered as replies, so that replying to the answer
+    # continues in a thread rooted at this message (see the seeding below).
+    reply_in_thread = chat_type == "group" and config.GROUP_CONTEXT_BY_THREAD
+    def respond(content: str) -> Optional[str]:
+        if reply_in_thread:
+            return lark_service.reply_message(msg_id, content)
+        return lark_service.send_message(chat_id, content)
+
     placeholder_id = None
     if config.ENABLE_SEND_AND_REPLACE:
-        placeholder_id = lark_service.send_message(chat_id, config.PLACEHOLDER_MESSAGE)
+        placeholder_id = respond(config.PLACEHOLDER_MESSAGE)
         if not placeholder_id:
             logger.warning("Failed to send placeholder message.", extra=log_context)
 
@@ -176,11 +187,17 @@ def lark_callback():
         role = settings.get('role') or config.DEFAULT_ROLE
         system_prompt = config.PROMPTS.get(role, config.PROMPTS['default'])
         
-        history = redis_service.get_chat_context(chat_id)
-        messages = [{"role": "system", "content": system_prompt}, *history, {"role": "user", "content": text_content}]
+        # Media is only downloaded once we know the bot is going to answer.
+        user_content, history_text = media_service.build_user_content(msg_id, text_content, resources)
+        history = redis_service.get_chat_context(chat_id, scope)
+        messages = [{"role": "system", "content": system_prompt}]
+        memories = run_async_from_sync(memory_service.recall(chat_id, text_content, scope, history))
+        if memories:
+            messages.append({"role": "system", "content": memory_service.format_memories(memories)})
+        messages.extend([*history, {"role": "user", "content": user_content}])
         
         logger.info("Requesting AI response for chat.", extra=log_context)
-        ai_response = run_async_from_sync(openai_service.get_ai_response(messages, model))
+        ai_response = run_async_from_sync(openai_service.get_ai_response(messages, model, chat_id))
 
         # 1. Remove <think> blocks used for chain-of-thought reasoning.
         ai_response = re.sub(r'<think>.*?</think>', '', ai_response, flags=re.DOTALL)
@@ -196,11 +213,16 @@ def lark_callback():
         if placeholder_id:
             lark_service.patch_message(placeholder_id, ai_response)
         else:
-            lark_service.send_message(chat_id, ai_response)
+            respond(ai_response)
 
-        history.append({"role": "user", "content": text_content})
+        history.append({"role": "user", "content": history_text})
         history.append({"role": "assistant", "content": ai_response})
-        redis_service.save_chat_context(chat_id, history)
+        redis_service.save_chat_context(chat_id, history, scope)
+        if reply_in_thread and not thread_root_id:
+            # A reply to this answer starts a thread rooted at this message; seed it with this turn.
+            thread_scope = lark_service.get_context_scope(message, sender, root_id=msg_id)
+            redis_service.save_chat_context(chat_id, history[-2:], thread_scope)
+        run_async_from_sync(memory_service.remember(chat_id, history_text, ai_response, scope))
         logger.info("Successfully processed message and sent response.", extra=log_context)
 
         return jsonify({"msg": "Successfully processed"})
@@ -225,7 +247,7 @@ def lark_callback():
         if placeholder_id:
             lark_service.patch_message(placeholder_id, user_friendly_error)
         else:
-            lark_service.send_message(chat_id, user_friendly_error)
+            respond(user_friendly_error)
             
         return jsonify({"msg": "Error occurred", "error_type": error_type}), 500
     finally:
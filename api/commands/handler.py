@@ -1,42 +1,68 @@
+from typing import Optional
 from api import config
 from api.config import PROMPTS
-from api.services import lark_service, redis_service
+from api.services import lark_service, redis_service, memory_service
 
-def handle_command(command: str, args: list, chat_id: str):
+def handle_command(command: str, args: list, chat_id: str, scope: Optional[str] = None, reply_to: Optional[str] = None):
     settings = redis_service.get_chat_settings(chat_id)
 
+    # Commands sent inside a thread are answered in that thread.
+    def send(text: str):
+        if reply_to:
+            lark_service.reply_message(reply_to, text)
+        else:
+            lark_service.send_message(chat_id, text)
+
     if command == "/help":
         roles = ", ".join([f"`{r}`" for r in PROMPTS.keys()])
         current_role = settings.get('role', config.DEFAULT_ROLE)
         text = (f"**🤖 Available Commands**\n\n"
                 f"- `/help`: Show this help message.\n"
-                f"- `/clear`: Clear conversation history.\n"
+                f"- `/clear [all]`: Clear conversation history. In group threads, only the current thread is cleared unless `all` is given.\n"
+                f"- `/usage`: Show token and tool usage of this chat over the last {redis_service.USAGE_WINDOW_DAYS} days.\n"
                 f"- `/model [model_name]`: Show or switch AI model. Current default: `{config.OPENAI_MODEL}`\n"
                 f"- `/role [role_name]`: Show or switch bot's role. Current role: `{current_role}`\n"
                 f"  Available roles: {roles}")
-        lark_service.send_message(chat_id, text)
+        send(text)
     elif command == "/clear":
+        if scope and not (args and args[0].strip().lower() == "all"):
+            redis_service.clear_chat_context(chat_id, scope)
+            memory_service.forget(chat_id, scope)
+            target = "this thread" if scope.startswith("thread:") else "your conversation"
+            send(f"✨ Conversation history of {target} has been cleared.")
+            return
         redis_service.clear_user_data(chat_id)
-        lark_service.send_message(chat_id, "✨ Conversation history and settings have been cleared.")
+        send("✨ Conversation history and settings have been cleared.")
+    elif command == "/usage":
+        usage = redis_service.get_chat_usage(chat_id)
+        if not usage:
+            send("ℹ️ No usage has been recorded for this chat yet.")
+            return
+        total_tokens = usage.get('prompt_tokens', 0) + usage.get('completion_tokens', 0)
+        text = (f"**📊 Usage (last {redis_service.USAGE_WINDOW_DAYS} days)**\n\n"
+                f"- Requests: **{usage.get('requests', 0)}** ({usage.get('api_calls', 0)} model calls)\n"
+                f"- Tokens: **{total_tokens}** (prompt {usage.get('prompt_tokens', 0)}, completion {usage.get('completion_tokens', 0)})\n"
+                f"- Tool calls: **{usage.get('tool_calls', 0)}** ({usage.get('tool_result_bytes', 0)} bytes of results)")
+        send(text)
     elif command == "/model":
         if not args:
             current_model = settings.get('model', config.OPENAI_MODEL)
-            lark_service.send_message(chat_id, f"ℹ️ Current model: **{current_model}**")
+            send(f"ℹ️ Current model: **{current_model}**")
             return
         model = args[0].strip()
         redis_service.set_chat_setting(chat_id, 'model', model)
-        lark_service.send_message(chat_id, f"✅ Model switched to: **{model}**")
+        send(f"✅ Model switched to: **{model}**")
     elif command == "/role":
         if not args:
             current_role = settings.get('role', config.DEFAULT_ROLE)
-            lark_service.send_message(chat_id, f"ℹ️ Current role: **{current_role}**")
+            send(f"ℹ️ Current role: **{current_role}**")
             return
         role = args[0].strip()
         if role not in PROMPTS:
-            lark_service.send_message(chat_id, f"❌ Role not found: **{role}**.")
+            send(f"❌ Role not found: **{role}**.")
             return
         redis_service.set_chat_setting(chat_id, 'role', role)
-        redis_service.clear_chat_context(chat_id)
-        lark_service.send_message(chat_id, f"🎭 Role switched to: **{role}**. Conversation history has been cleared.")
+        redis_service.clear_all_chat_contexts(chat_id)
+        send(f"🎭 Role switched to: **{role}**. Conversation history has been cleared.")
     else:
-        lark_service.send_message(chat_id, f"🤷‍♀️ Unknown command: **{command}**.")
+        send(f"🤷‍♀️ Unknown command: **{command}**.")
@@ -1,4 +1,5 @@
 import os
+import tempfile
 from typing import Optional
 from dotenv import load_dotenv
 
@@ -19,6 +20,12 @@ OPENAI_TEMPERATURE = float(os.getenv("OPENAI_TEMPERATURE", 0.7))
 OPENAI_TOP_P = float(os.getenv("OPENAI_TOP_P", 1.0))
 OPENAI_MAX_TOKENS = int(os.getenv("OPENAI_MAX_TOKENS", 4096))
 
+# Per-request budgets for the tool-calling loop. A value of 0 disables the limit.
+REQUEST_MAX_TOOL_ITERATIONS = int(os.getenv("REQUEST_MAX_TOOL_ITERATIONS", 8))
+REQUEST_DEADLINE_SECONDS = float(os.getenv("REQUEST_DEADLINE_SECONDS", 120))
+REQUEST_MAX_TOTAL_TOKENS = int(os.getenv("REQUEST_MAX_TOTAL_TOKENS", 0))
+REQUEST_MAX_TOOL_RESULT_BYTES = int(os.getenv("REQUEST_MAX_TOOL_RESULT_BYTES", 256 * 1024))
+
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 ENABLE_SEND_AND_REPLACE = os.getenv("ENABLE_SEND_AND_REPLACE", "true").lower() == 'true'
@@ -30,6 +37,30 @@ PLACEHOLDER_MESSAGE = os.getenv("PLACEHOLDER_MESSAGE", "Thinking, please wait...
 
 CHAT_CONTEXT_MAX_MESSAGES = int(os.getenv("CHAT_CONTEXT_MAX_MESSAGES", 20))
 MAX_MESSAGE_AGE_SECONDS = int(os.getenv("MAX_MESSAGE_AGE_SECONDS", 300))
+GROUP_CONTEXT_BY_THREAD = os.getenv("GROUP_CONTEXT_BY_THREAD", "true").lower() == 'true'
+GROUP_CONTEXT_BY_SENDER = os.getenv("GROUP_CONTEXT_BY_SENDER", "false").lower() == 'true'
+
+ENABLE_LONG_TERM_MEMORY = os.getenv("ENABLE_LONG_TERM_MEMORY", "false").lower() == 'true'
+MEMORY_EMBEDDING_BACKEND = os.getenv("MEMORY_EMBEDDING_BACKEND", "openai").strip().lower()
+MEMORY_EMBEDDING_MODEL = os.getenv("MEMORY_EMBEDDING_MODEL", "text-embedding-3-small")
+MEMORY_EMBEDDING_BASE_URL = os.getenv("MEMORY_EMBEDDING_BASE_URL") or OPENAI_BASE_URL
+MEMORY_EMBEDDING_API_KEY = os.getenv("MEMORY_EMBEDDING_API_KEY") or OPENAI_API_KEY
+MEMORY_LOCAL_EMBEDDING_DIM = int(os.getenv("MEMORY_LOCAL_EMBEDDING_DIM", 512))
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", 3))
+MEMORY_MIN_SIMILARITY = float(os.getenv("MEMORY_MIN_SIMILARITY", 0.35))
+MEMORY_MAX_ITEMS = int(os.getenv("MEMORY_MAX_ITEMS", 500))
+MEMORY_TTL_DAYS = int(os.getenv("MEMORY_TTL_DAYS", 30))
+MEMORY_SNIPPET_MAX_CHARS = int(os.getenv("MEMORY_SNIPPET_MAX_CHARS", 1000))
+MEMORY_OTHER_THREAD_WEIGHT = float(os.getenv("MEMORY_OTHER_THREAD_WEIGHT", 0.8))
+
+ENABLE_IMAGE_INPUT = os.getenv("ENABLE_IMAGE_INPUT", "true").lower() == 'true'
+MEDIA_MAX_DOWNLOAD_BYTES = int(os.getenv("MEDIA_MAX_DOWNLOAD_BYTES", 20 * 1024 * 1024))
+MEDIA_IMAGE_MAX_SIDE = int(os.getenv("MEDIA_IMAGE_MAX_SIDE", 1024))
+MEDIA_IMAGE_QUALITY = int(os.getenv("MEDIA_IMAGE_QUALITY", 85))
+MEDIA_MAX_IMAGE_PIXELS = int(os.getenv("MEDIA_MAX_IMAGE_PIXELS", 4096 * 4096))
+MEDIA_MAX_FILE_TEXT_CHARS = int(os.getenv("MEDIA_MAX_FILE_TEXT_CHARS", 20000))
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "lark_bot_media")
+MEDIA_CACHE_TTL_SECONDS = int(os.getenv("MEDIA_CACHE_TTL_SECONDS", 7 * 86400))
 
 PROMPTS_DIR = os.path.join(PROJECT_ROOT, 'prompts')
 PROMPTS: dict = {}
@@ -2,7 +2,7 @@ import requests
 import json
 import logging
 from typing import Optional
-from api.config import LARK_APP_ID, LARK_APP_SECRET
+from api.config import LARK_APP_ID, LARK_APP_SECRET, GROUP_CONTEXT_BY_THREAD, GROUP_CONTEXT_BY_SENDER
 from api.services.redis_service import get_lark_token_from_cache, set_lark_token_to_cache
 
 def get_lark_access_token() -> Optional[str]:
@@ -52,6 +52,32 @@ def send_message(chat_id: str, content: str) -> Optional[str]:
         logging.error(f"Exception sending Lark message: {e}")
     return None
 
+def reply_message(message_id: str, content: str) -> Optional[str]:
+    """Replies to a message so the answer stays inside the same thread."""
+    access_token = get_lark_access_token()
+    if not access_token: return None
+    
+    url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}/reply"
+    card_content = {
+        "config": {"wide_screen_mode": True},
+        "elements": [{"tag": "markdown", "content": content}]
+    }
+    payload = {
+        "msg_type": "interactive",
+        "content": json.dumps(card_content)
+    }
+    headers = {"Authorization": f"Bearer {access_token}"}
+    
+    try:
+        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        data = response.json()
+        if data.get("code") == 0:
+            return data.get("data", {}).get("message_id")
+        logging.error(f"Failed to reply to Lark message {message_id}: {data}")
+    except Exception as e:
+        logging.error(f"Exception replying to Lark message {message_id}: {e}")
+    return None
+
 def patch_message(message_id: str, content: str) -> bool:
     access_token = get_lark_access_token()
     if not access_token: return False
@@ -103,6 +129,87 @@ def get_bot_open_id() -> Optional[str]:
         logging.error(f"Exception while getting bot info: {e}")
     return None
 
+def download_message_resource(message_id: str, file_key: str, resource_type: str, dest_path: str, max_bytes: int) -> bool:
+    """
+    Streams an image/file attached to a message into `dest_path` without holding it in memory.
+    Gives up (and returns False) once the download grows beyond `max_bytes`.
+    """
+    access_token = get_lark_access_token()
+    if not access_token: return False
+    
+    url = f"https://open.feishu.cn/open-apis/im/v1/messages/{message_id}/resources/{file_key}"
+    headers = {"Authorization": f"Bearer {access_token}"}
+    
+    try:
+        with requests.get(url, headers=headers, params={"type": resource_type}, stream=True, timeout=(5, 30)) as response:
+            if response.status_code != 200:
+                logging.error(f"Failed to download Lark resource {file_key}: HTTP {response.status_code} {response.text[:200]}")
+                return False
+            declared_size = int(response.headers.get("Content-Length") or 0)
+            if declared_size > max_bytes:
+                logging.warning(f"Lark resource {file_key} is too large ({declared_size} bytes), skipping.")
+                return False
+            received = 0
+            with open(dest_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    received += len(chunk)
+                    if received > max_bytes:
+                        logging.warning(f"Lark resource {file_key} exceeded {max_bytes} bytes, aborting download.")
+                        return False
+                    f.write(chunk)
+        return True
+    except Exception as e:
+        logging.error(f"Exception downloading Lark resource {file_key}: {e}")
+    return False
+
+def _parse_post_content(content: dict):
+    # Post content is either {"title", "content"} or wrapped in a locale key such as "zh_cn".
+    if "content" not in content:
+        content = next((v for v in content.values() if isinstance(v, dict) and "content" in v), {})
+    lines, resources = [], []
+    if content.get("title"):
+        lines.append(content["title"])
+    for paragraph in content.get("content") or []:
+        parts = []
+        for element in paragraph:
+            tag = element.get("tag")
+            if tag in ("text", "a"):
+                parts.append(element.get("text", ""))
+            elif tag == "at":
+                user_name = element.get("user_name")
+                parts.append(f"@{user_name}" if user_name else element.get("user_id", ""))
+            elif tag == "code_block":
+                parts.append(f"\n```{element.get('language', '').lower()}\n{element.get('text', '')}\n```\n")
+            elif tag == "img" and element.get("image_key"):
+                resources.append({"type": "image", "key": element["image_key"]})
+            elif tag == "media" and element.get("file_key"):
+                resources.append({"type": "file", "key": element["file_key"], "name": element.get("file_name", "")})
+        lines.append("".join(parts))
+    return "\n".join(lines).strip(), resources
+
+def parse_message_content(message: dict):
+    """
+    Extracts the text and attached resources of a text, post, image or file message.
+    Resources are dicts with "type" ("image"/"file"), "key" and, for files, "name".
+    """
+    msg_type = message.get("message_type", "text")
+    try:
+        content = json.loads(message.get("content") or "{}")
+    except json.JSONDecodeError:
+        logging.error(f"Could not parse content of {msg_type} message {message.get('message_id')}.")
+        return "", []
+
+    if msg_type == "text":
+        return content.get("text", "").strip(), []
+    if msg_type == "post":
+        return _parse_post_content(content)
+    if msg_type == "image" and content.get("image_key"):
+        return "", [{"type": "image", "key": content["image_key"]}]
+    if msg_type == "file" and content.get("file_key"):
+        return "", [{"type": "file", "key": content["file_key"], "name": content.get("file_name", "")}]
+    logging.info(f"Unsupported message type '{msg_type}' ignored.")
+    return "", []
+
 def resolve_mentions(text_content: str, mentions: list) -> str:
     """Replaces mention placeholders in text with actual user names."""
     if not mentions:
@@ -120,3 +227,24 @@ def resolve_mentions(text_content: str, mentions: list) -> str:
             logging.error(f"Error processing a mention: {mention}. Error: {e}")
             
     return text_content
+
+def get_thread_root_id(message: dict) -> Optional[str]:
+    """Returns the root message id of the thread/reply chain a message belongs to, if any."""
+    return message.get("root_id") or message.get("parent_id") or None
+
+def get_context_scope(message: dict, sender: dict, root_id: Optional[str] = None) -> Optional[str]:
+    """
+    Builds the context scope for a message. In group chats, conversations are split by
+    thread and optionally by sender; anything else falls back to the chat-level context (None).
+    `root_id` overrides the thread the message belongs to.
+    """
+    if message.get("chat_type") != "group":
+        return None
+    parts = []
+    root_id = root_id or get_thread_root_id(message)
+    if GROUP_CONTEXT_BY_THREAD and root_id:
+        parts.append(f"thread:{root_id}")
+    sender_open_id = sender.get("sender_id", {}).get("open_id")
+    if GROUP_CONTEXT_BY_SENDER and sender_open_id:
+        parts.append(f"user:{sender_open_id}")
+    return ":".join(parts) or None
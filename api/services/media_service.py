@@ -0,0 +1,223 @@
+import base64
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import time
+from typing import List, Dict, Any, Optional, Tuple
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from api import config
+from api.services import lark_service, redis_service
+
+logger = logging.getLogger(__name__)
+
+# How often (per process) the cache directory is swept, and how long leftovers of interrupted writes may stay.
+_PRUNE_INTERVAL_SECONDS = 600
+_TEMP_FILE_MAX_AGE_SECONDS = 3600
+_last_prune = 0.0
+
+
+class _ImageTooLarge(Exception):
+    """Raised for images that would exceed MEDIA_MAX_IMAGE_PIXELS once decoded."""
+
+
+def _cache_path(filename: str) -> str:
+    return os.path.join(config.MEDIA_CACHE_DIR, filename)
+
+def _write_blob(data: bytes, suffix: str) -> str:
+    """Stores processed media under the hash of its bytes, so identical media is kept once."""
+    filename = hashlib.sha256(data).hexdigest() + suffix
+    path = _cache_path(filename)
+    if os.path.exists(path):
+        # Another key points at the same bytes now; keep the blob for as long as that pointer lives.
+        os.utime(path)
+    else:
+        os.makedirs(config.MEDIA_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=config.MEDIA_CACHE_DIR, suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    _prune_cache()
+    return filename
+
+def _prune_cache():
+    """Deletes blobs older than MEDIA_CACHE_TTL_SECONDS, whose Redis pointers have expired as well."""
+    global _last_prune
+    now = time.time()
+    if now - _last_prune < _PRUNE_INTERVAL_SECONDS:
+        return
+    _last_prune = now
+    removed = 0
+    try:
+        with os.scandir(config.MEDIA_CACHE_DIR) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                is_temp = entry.name.endswith((".part", ".download"))
+                max_age = _TEMP_FILE_MAX_AGE_SECONDS if is_temp else config.MEDIA_CACHE_TTL_SECONDS
+                try:
+                    if now - entry.stat().st_mtime > max_age:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    pass
+    except OSError as e:
+        logger.error(f"Failed to prune media cache at {config.MEDIA_CACHE_DIR}: {e}")
+        return
+    if removed:
+        logger.info(f"Pruned {removed} expired files from the media cache.")
+
+def _read_blob(filename: str) -> Optional[bytes]:
+    try:
+        with open(_cache_path(filename), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+def _encode_image(path: str) -> Optional[bytes]:
+    """
+    Downscales an image to MEDIA_IMAGE_MAX_SIDE and re-encodes it as JPEG, or returns None if it isn't one.
+    Raises _ImageTooLarge for images over MEDIA_MAX_IMAGE_PIXELS.
+    """
+    max_side = config.MEDIA_IMAGE_MAX_SIDE
+    try:
+        with Image.open(path) as img:
+            # Lets the JPEG decoder skip straight to a reduced resolution instead of decoding full size.
+            img.draft("RGB", (max_side, max_side))
+            # Other formats are always decoded at full size, so refuse images that would take too much memory.
+            if img.width * img.height > config.MEDIA_MAX_IMAGE_PIXELS:
+                raise _ImageTooLarge(f"{img.width}x{img.height} pixels")
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                background = Image.new("RGB", img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel("A"))
+                img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+            out = io.BytesIO()
+            img.save(out, format="JPEG", quality=config.MEDIA_IMAGE_QUALITY, optimize=True)
+            return out.getvalue()
+    except Image.DecompressionBombError as e:
+        raise _ImageTooLarge(str(e)) from e
+    except (UnidentifiedImageError, OSError) as e:
+        logger.info(f"Resource at {path} is not a usable image: {e}")
+        return None
+
+def _extract_text(path: str) -> Optional[str]:
+    """Returns the leading MEDIA_MAX_FILE_TEXT_CHARS of a UTF-8 text file, or None for binary files."""
+    max_chars = config.MEDIA_MAX_FILE_TEXT_CHARS
+    with open(path, "rb") as f:
+        data = f.read(max_chars * 4)
+    if b"\x00" in data:
+        return None
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # Reading a fixed number of bytes may cut the last character in half.
+        if e.start < len(data) - 3:
+            return None
+        text = data[:e.start].decode("utf-8")
+    return text[:max_chars]
+
+def _process_resource(message_id: str, resource: Dict[str, Any]) -> Dict[str, Any]:
+    """Downloads and processes one resource into a cache entry."""
+    resource_type = resource["type"]
+    os.makedirs(config.MEDIA_CACHE_DIR, exist_ok=True)
+    fd, download_path = tempfile.mkstemp(dir=config.MEDIA_CACHE_DIR, suffix=".download")
+    os.close(fd)
+    try:
+        if not lark_service.download_message_resource(
+            message_id, resource["key"], resource_type, download_path, config.MEDIA_MAX_DOWNLOAD_BYTES
+        ):
+            return {"kind": "unavailable"}
+
+        try:
+            image = _encode_image(download_path)
+        except _ImageTooLarge as e:
+            logger.warning(f"Resource {resource['key']} is too large to decode ({e}), MEDIA_MAX_IMAGE_PIXELS is {config.MEDIA_MAX_IMAGE_PIXELS}.")
+            # The verdict depends on the pixel cap, so remember which cap it was made with.
+            return {"kind": "too_large", "max_pixels": config.MEDIA_MAX_IMAGE_PIXELS}
+        if image is not None:
+            return {"kind": "image", "blob": _write_blob(image, ".jpg")}
+        if resource_type == "file":
+            text = _extract_text(download_path)
+            if text is not None:
+                return {"kind": "text", "blob": _write_blob(text.encode("utf-8"), ".txt")}
+        return {"kind": "unsupported"}
+    finally:
+        try:
+            os.remove(download_path)
+        except OSError:
+            pass
+
+def _load_resource(message_id: str, resource: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[bytes]]:
+    """Returns the cache entry for a resource and its processed bytes, downloading only on a cache miss."""
+    entry = redis_service.get_media_cache_entry(resource["key"])
+    if entry and entry["kind"] == "too_large" and entry.get("max_pixels") != config.MEDIA_MAX_IMAGE_PIXELS:
+        # Re-check images rejected under a different pixel cap.
+        entry = None
+    if entry and entry.get("blob"):
+        data = _read_blob(entry["blob"])
+        if data is not None:
+            return entry, data
+    elif entry:
+        return entry, None
+
+    entry = _process_resource(message_id, resource)
+    # Failed downloads are not cached so that the next message can retry.
+    if entry["kind"] != "unavailable":
+        redis_service.set_media_cache_entry(resource["key"], entry, config.MEDIA_CACHE_TTL_SECONDS)
+    data = _read_blob(entry["blob"]) if entry.get("blob") else None
+    return entry, data
+
+def build_user_content(message_id: str, text: str, resources: List[Dict[str, Any]]):
+    """
+    Turns the text and resources of a message into the `content` of a user message and
+    a text-only version of it for the chat history (images are not kept in Redis).
+    """
+    text_parts = [text] if text else []
+    history_parts = [text] if text else []
+    image_parts = []
+
+    for resource in resources:
+        name = resource.get("name") or resource["key"]
+        if resource["type"] == "image" and not config.ENABLE_IMAGE_INPUT:
+            text_parts.append("[Image] (image input is disabled)")
+            history_parts.append("[Image]")
+            continue
+        try:
+            entry, data = _load_resource(message_id, resource)
+        except Exception as e:
+            logger.error(f"Failed to load resource {resource['key']} of message {message_id}: {e}", exc_info=True)
+            entry, data = {"kind": "unavailable"}, None
+
+        if entry["kind"] == "image" and data is not None:
+            label = "[Image]" if resource["type"] == "image" else f"[Image: {name}]"
+            history_parts.append(label)
+            if config.ENABLE_IMAGE_INPUT:
+                image_url = "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii")
+                image_parts.append({"type": "image_url", "image_url": {"url": image_url}})
+            else:
+                text_parts.append(f"{label} (image input is disabled)")
+        elif entry["kind"] == "text" and data is not None:
+            text_parts.append(f"[File: {name}]\n```\n{data.decode('utf-8')}\n```")
+            history_parts.append(f"[File: {name}]")
+        else:
+            label = "[Image]" if resource["type"] == "image" else f"[File: {name}]"
+            reason = {
+                "unsupported": "unsupported file type",
+                "too_large": "image too large",
+            }.get(entry["kind"], "could not be downloaded")
+            text_parts.append(f"{label} ({reason})")
+            history_parts.append(label)
+
+    history_text = "\n\n".join(history_parts)
+    if not image_parts:
+        return "\n\n".join(text_parts), history_text
+    content = [{"type": "text", "text": "\n\n".join(text_parts)}] if text_parts else []
+    return content + image_parts, history_text
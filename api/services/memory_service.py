@@ -0,0 +1,203 @@
+import abc
+import base64
+import logging
+import re
+import time
+import zlib
+from typing import List, Dict, Any, Optional
+
+import numpy as np
+import openai
+
+from api import config
+from api.services import redis_service
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9_]+|[^\sa-z0-9_]", re.IGNORECASE)
+_CJK_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯]")
+
+
+class EmbeddingBackend(abc.ABC):
+    """Turns a batch of texts into an (n, dim) float32 matrix."""
+    name = "base"
+
+    @abc.abstractmethod
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        ...
+
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """Embeddings from any OpenAI-compatible `/embeddings` endpoint."""
+
+    def __init__(self, model: str, api_key: Optional[str], base_url: Optional[str]):
+        self.name = f"openai:{model}"
+        self.model = model
+        self.client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url)
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        response = await self.client.embeddings.create(
+            model=self.model, input=texts, timeout=config.OPENAI_API_TIMEOUT
+        )
+        ordered = sorted(response.data, key=lambda item: item.index)
+        return np.asarray([item.embedding for item in ordered], dtype=np.float32)
+
+
+class LocalHashingEmbeddingBackend(EmbeddingBackend):
+    """
+    Offline stand-in that hashes words and CJK character bigrams into a fixed-size vector.
+    Much weaker than a real model, but needs no network and is stable across processes.
+    """
+
+    def __init__(self, dim: int):
+        self.name = f"local:{dim}"
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        tokens = _TOKEN_PATTERN.findall(text.lower())
+        words = [t for t in tokens if not _CJK_PATTERN.match(t) and t.isalnum()]
+        cjk = [t for t in tokens if _CJK_PATTERN.match(t)]
+        bigrams = [a + b for a, b in zip(cjk, cjk[1:])]
+        return words + cjk + bigrams
+
+    async def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                matrix[row, h % self.dim] += 1.0 if h & 0x80000000 else -1.0
+        return matrix
+
+
+_backend: Optional[EmbeddingBackend] = None
+
+def get_embedding_backend() -> EmbeddingBackend:
+    global _backend
+    if _backend is None:
+        if config.MEMORY_EMBEDDING_BACKEND == "local":
+            _backend = LocalHashingEmbeddingBackend(config.MEMORY_LOCAL_EMBEDDING_DIM)
+        else:
+            if config.MEMORY_EMBEDDING_BACKEND != "openai":
+                logger.warning(f"Unknown MEMORY_EMBEDDING_BACKEND '{config.MEMORY_EMBEDDING_BACKEND}', falling back to 'openai'.")
+            _backend = OpenAIEmbeddingBackend(
+                config.MEMORY_EMBEDDING_MODEL,
+                config.MEMORY_EMBEDDING_API_KEY,
+                config.MEMORY_EMBEDDING_BASE_URL,
+            )
+    return _backend
+
+def _normalize(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _load(chat_id: str, backend: EmbeddingBackend):
+    """
+    Returns (ids, vectors, items) for a chat in insertion order, skipping items
+    embedded by a different backend or with a different dimension.
+    """
+    items, encoded_vectors = redis_service.get_chat_memory_items(chat_id)
+    ids, rows = [], []
+    for item_id in sorted(items.keys() & encoded_vectors.keys()):
+        if items[item_id].get("backend") == backend.name:
+            ids.append(item_id)
+            rows.append(base64.b64decode(encoded_vectors[item_id]))
+    if not ids:
+        return [], None, []
+    row_size = len(rows[-1])
+    keep = [idx for idx, row in enumerate(rows) if len(row) == row_size]
+    ids = [ids[idx] for idx in keep]
+    vectors = np.frombuffer(b"".join(rows[idx] for idx in keep), dtype=np.float32).reshape(len(keep), -1)
+    return ids, vectors, [items[item_id] for item_id in ids]
+
+def _snippet(user_text: str, assistant_text: str) -> str:
+    return f"User: {user_text}\nAssistant: {assistant_text}"[:config.MEMORY_SNIPPET_MAX_CHARS]
+
+def _scope_part(scope: Optional[str], kind: str) -> Optional[str]:
+    """Extracts the thread or user id from a scope such as "thread:<root_id>:user:<open_id>"."""
+    match = re.search(rf"(?:^|:){kind}:([^:]+)", scope or "")
+    return match.group(1) if match else None
+
+async def recall(chat_id: str, query: str, scope: Optional[str] = None,
+                 history: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+    """
+    Returns up to MEMORY_TOP_K stored snippets whose cosine similarity to `query`
+    is at least MEMORY_MIN_SIMILARITY, most relevant first. Turns that are still part
+    of the short-term `history` are skipped. With per-sender contexts only the sender's
+    own snippets are searched, and snippets from other threads are down-weighted.
+    """
+    if not config.ENABLE_LONG_TERM_MEMORY or not query:
+        return []
+    try:
+        backend = get_embedding_backend()
+        ids, vectors, items = _load(chat_id, backend)
+        if vectors is None:
+            return []
+        history = history or []
+        in_history = {
+            _snippet(user["content"], assistant["content"])
+            for user, assistant in zip(history[::2], history[1::2])
+            if isinstance(user.get("content"), str)
+        }
+        user_id = _scope_part(scope, "user")
+        searchable = np.array([
+            item["text"] not in in_history
+            and (not config.GROUP_CONTEXT_BY_SENDER or _scope_part(item.get("scope"), "user") == user_id)
+            for item in items
+        ], dtype=bool)
+        if not searchable.any():
+            return []
+        thread_id = _scope_part(scope, "thread")
+        weights = np.array([
+            1.0 if _scope_part(item.get("scope"), "thread") == thread_id else config.MEMORY_OTHER_THREAD_WEIGHT
+            for item in items
+        ], dtype=np.float32)
+
+        query_vector = _normalize(await backend.embed([query]))[0]
+        scores = (vectors @ query_vector) * weights
+        scores[~searchable] = -np.inf
+
+        k = min(config.MEMORY_TOP_K, int(searchable.sum()))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] >= config.MEMORY_MIN_SIMILARITY]
+        if top.size == 0:
+            return []
+
+        redis_service.touch_chat_memory_items(chat_id, [ids[idx] for idx in top], time.time())
+
+        if config.DEBUG_MODE:
+            logger.debug("Recalled %d memories for chat %s with scores %s", top.size, chat_id, scores[top].tolist())
+        return [items[idx]["text"] for idx in top]
+    except Exception as e:
+        logger.error(f"Failed to recall memories for chat {chat_id}: {e}", exc_info=True)
+        return []
+
+async def remember(chat_id: str, user_text: str, assistant_text: str, scope: Optional[str] = None):
+    """Embeds a finished question/answer turn and stores it, evicting the least recently used snippets over MEMORY_MAX_ITEMS."""
+    if not config.ENABLE_LONG_TERM_MEMORY:
+        return
+    try:
+        backend = get_embedding_backend()
+        snippet = _snippet(user_text, assistant_text)
+        vector = _normalize(await backend.embed([snippet]))[0].astype(np.float32)
+        item = {"text": snippet, "created": time.time(), "scope": scope, "backend": backend.name}
+        redis_service.add_chat_memory_item(
+            chat_id, item, base64.b64encode(vector.tobytes()).decode("ascii"),
+            config.MEMORY_MAX_ITEMS, config.MEMORY_TTL_DAYS * 86400,
+        )
+    except Exception as e:
+        logger.error(f"Failed to store memory for chat {chat_id}: {e}", exc_info=True)
+
+def forget(chat_id: str, scope: Optional[str]):
+    """Drops the snippets that were stored for one context scope of a chat."""
+    items, _ = redis_service.get_chat_memory_items(chat_id)
+    redis_service.delete_chat_memory_items(chat_id, [item_id for item_id, item in items.items() if item.get("scope") == scope])
+
+def format_memories(memories: List[str]) -> str:
+    snippets = "\n\n---\n\n".join(memories)
+    return (
+        "Relevant excerpts from earlier conversations in this chat. "
+        "They may be outdated; use them only if they help answer the current message.\n\n"
+        f"{snippets}"
+    )
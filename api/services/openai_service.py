@@ -2,64 +2,176 @@ import openai
 import logging
 import json
 import asyncio
-from typing import List, Dict, Any
+import time
+from typing import List, Dict, Any, Optional
 from api import config
+from api.services import redis_service
 from api.services.mcp_service import mcp_manager
 
 client = openai.AsyncOpenAI(api_key=config.OPENAI_API_KEY, base_url=config.OPENAI_BASE_URL)
 logger = logging.getLogger(__name__)
 
-async def get_ai_response(messages: List[Dict[str, Any]], model: str) -> str:
-    tools = mcp_manager.get_all_tools()
-    
-    current_messages = list(messages)
+class RequestBudget:
+    """Tracks what a single user request has consumed against the REQUEST_* limits."""
+
+    # Another tool round is not started when less time than this is left before the deadline.
+    MIN_ROUND_SECONDS = 10
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.deadline = self.started_at + config.REQUEST_DEADLINE_SECONDS if config.REQUEST_DEADLINE_SECONDS else None
+        self.requests = 0
+        self.tool_iterations = 0
+        self.tool_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.tool_result_bytes = 0
+
+    def add_usage(self, usage):
+        self.requests += 1
+        if usage:
+            self.prompt_tokens += usage.prompt_tokens or 0
+            self.completion_tokens += usage.completion_tokens or 0
 
-    while True:
-        params = {
-            "model": model,
-            "messages": current_messages,
-            "temperature": config.OPENAI_TEMPERATURE,
-            "top_p": config.OPENAI_TOP_P,
-            "timeout": config.OPENAI_API_TIMEOUT,
+    def remaining_tool_result_bytes(self) -> Optional[int]:
+        if not config.REQUEST_MAX_TOOL_RESULT_BYTES:
+            return None
+        return max(config.REQUEST_MAX_TOOL_RESULT_BYTES - self.tool_result_bytes, 0)
+
+    def exhausted_reason(self) -> Optional[str]:
+        if config.REQUEST_MAX_TOOL_ITERATIONS and self.tool_iterations >= config.REQUEST_MAX_TOOL_ITERATIONS:
+            return f"tool iteration limit ({config.REQUEST_MAX_TOOL_ITERATIONS}) reached"
+        remaining = self.remaining_seconds()
+        if remaining is not None and remaining < self.MIN_ROUND_SECONDS:
+            return f"deadline ({config.REQUEST_DEADLINE_SECONDS:g}s) reached"
+        if config.REQUEST_MAX_TOTAL_TOKENS and self.prompt_tokens + self.completion_tokens >= config.REQUEST_MAX_TOTAL_TOKENS:
+            return f"token limit ({config.REQUEST_MAX_TOTAL_TOKENS}) reached"
+        if self.remaining_tool_result_bytes() == 0:
+            return f"tool result limit ({config.REQUEST_MAX_TOOL_RESULT_BYTES} bytes) reached"
+        return None
+
+    def remaining_seconds(self) -> Optional[float]:
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+    def as_usage(self) -> Dict[str, int]:
+        return {
+            "requests": 1,
+            "api_calls": self.requests,
+            "tool_calls": self.tool_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "tool_result_bytes": self.tool_result_bytes,
         }
-        if config.OPENAI_MAX_TOKENS:
-            params["max_tokens"] = config.OPENAI_MAX_TOKENS
-        
-        if tools:
-            params["tools"] = tools
-            params["tool_choice"] = "auto"
 
-        if config.DEBUG_MODE:
-            logger.debug("Sending request to OpenAI: %s", json.dumps(params, indent=2, ensure_ascii=False))
+def _truncate_utf8(text: str, max_bytes: int) -> str:
+    return text.encode("utf-8")[:max_bytes].decode("utf-8", errors="ignore")
+
+async def get_ai_response(messages: List[Dict[str, Any]], model: str, chat_id: Optional[str] = None) -> str:
+    tools = mcp_manager.get_all_tools()
 
-        completion = await client.chat.completions.create(**params)
+    current_messages = list(messages)
+    budget = RequestBudget()
+    exhausted_reason = None
 
-        if config.DEBUG_MODE:
-            logger.debug("Received response from OpenAI: %s", completion.model_dump_json(indent=2))
+    try:
+        while True:
+            # Tool calls and the model calls following a tool round are bounded by the deadline; the first
+            # call and the forced final answer get the full API timeout so the user always receives a reply.
+            deadline_bounded = budget.tool_iterations > 0 and not exhausted_reason and budget.deadline is not None
+            timeout = config.OPENAI_API_TIMEOUT
+            if deadline_bounded:
+                timeout = min(timeout, budget.remaining_seconds())
+            params = {
+                "model": model,
+                "messages": current_messages,
+                "temperature": config.OPENAI_TEMPERATURE,
+                "top_p": config.OPENAI_TOP_P,
+                "timeout": timeout,
+            }
+            if config.OPENAI_MAX_TOKENS:
+                params["max_tokens"] = config.OPENAI_MAX_TOKENS
 
-        response_message = completion.choices[0].message
-        tool_calls = response_message.tool_calls
+            if tools:
+                params["tools"] = tools
+                # Once a budget is exhausted, the model must answer with what it already has.
+                params["tool_choice"] = "none" if exhausted_reason else "auto"
 
-        if not tool_calls:
-            return response_message.content or "No content returned."
+            if config.DEBUG_MODE:
+                logger.debug("Sending request to OpenAI: %s", json.dumps(params, indent=2, ensure_ascii=False))
 
-        current_messages.append(response_message.model_dump())
+            # Retries would let a deadline-bounded call run several times past the deadline.
+            api_client = client.with_options(max_retries=0) if deadline_bounded else client
+            try:
+                completion = await api_client.chat.completions.create(**params)
+            except openai.APITimeoutError:
+                if not deadline_bounded:
+                    raise
+                exhausted_reason = f"deadline ({config.REQUEST_DEADLINE_SECONDS:g}s) reached during a model call"
+                logger.warning(f"Request budget exhausted for chat {chat_id}: {exhausted_reason}. Forcing a final answer.")
+                continue
+            budget.add_usage(completion.usage)
 
-        for tool_call in tool_calls:
-            function_name = tool_call.function.name
-            function_args = tool_call.function.arguments
-            
             if config.DEBUG_MODE:
-                logger.debug(f"AI requested to call tool '{function_name}' with args: {function_args}")
-
-            tool_result = await mcp_manager.call_tool(
-                tool_name=function_name,
-                tool_args=function_args
-            )
-            
-            current_messages.append({
-                "tool_call_id": tool_call.id,
-                "role": "tool",
-                "name": function_name,
-                "content": tool_result,
-            })
+                logger.debug("Received response from OpenAI: %s", completion.model_dump_json(indent=2))
+
+            response_message = completion.choices[0].message
+            tool_calls = response_message.tool_calls
+
+            if not tool_calls or exhausted_reason:
+                return response_message.content or "No content returned."
+
+            current_messages.append(response_message.model_dump())
+            budget.tool_iterations += 1
+
+            deadline_hit = False
+            for tool_call in tool_calls:
+                function_name = tool_call.function.name
+                function_args = tool_call.function.arguments
+
+                # Every tool call needs a matching tool message, even when it is skipped.
+                remaining_bytes = budget.remaining_tool_result_bytes()
+                if remaining_bytes == 0:
+                    tool_result = f"Error: Tool '{function_name}' was not called because the tool result budget is exhausted."
+                elif deadline_hit:
+                    tool_result = f"Error: Tool '{function_name}' was not called because the request deadline was reached."
+                else:
+                    if config.DEBUG_MODE:
+                        logger.debug(f"AI requested to call tool '{function_name}' with args: {function_args}")
+
+                    budget.tool_calls += 1
+                    tool_coro = mcp_manager.call_tool(
+                        tool_name=function_name,
+                        tool_args=function_args
+                    )
+                    try:
+                        if budget.deadline is None:
+                            tool_result = await tool_coro
+                        else:
+                            # A hung tool must not hold the worker past the deadline.
+                            tool_result = await asyncio.wait_for(tool_coro, timeout=max(budget.remaining_seconds(), 0))
+                    except asyncio.TimeoutError:
+                        deadline_hit = True
+                        exhausted_reason = f"deadline ({config.REQUEST_DEADLINE_SECONDS:g}s) reached during tool '{function_name}'"
+                        tool_result = f"Error: Tool '{function_name}' did not finish before the request deadline."
+                    else:
+                        result_bytes = len(tool_result.encode("utf-8"))
+                        if remaining_bytes is not None and result_bytes > remaining_bytes:
+                            tool_result = _truncate_utf8(tool_result, remaining_bytes) + "\n[Truncated: tool result budget exhausted.]"
+                            result_bytes = remaining_bytes
+                        budget.tool_result_bytes += result_bytes
+
+                current_messages.append({
+                    "tool_call_id": tool_call.id,
+                    "role": "tool",
+                    "name": function_name,
+                    "content": tool_result,
+                })
+
+            exhausted_reason = exhausted_reason or budget.exhausted_reason()
+            if exhausted_reason:
+                logger.warning(f"Request budget exhausted for chat {chat_id}: {exhausted_reason}. Forcing a final answer.")
+    finally:
+        if chat_id:
+            redis_service.record_chat_usage(chat_id, budget.as_usage())
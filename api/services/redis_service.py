@@ -1,7 +1,8 @@
 import redis
 import json
 import logging
-from typing import Dict, Any, List, Optional
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Tuple
 from api.config import REDIS_URL, CLEAR_REDIS_ON_STARTUP
 
 r: Optional[redis.Redis] = None
@@ -20,14 +21,106 @@ def init_redis():
         logging.error(f"Could not connect to Redis: {e}.")
         r = None
 
-def get_chat_context(chat_id: str) -> List[Dict[str, Any]]:
+def _chat_context_key(chat_id: str, scope: Optional[str] = None) -> str:
+    # A scope (e.g. "thread:<root_id>") narrows the context to part of a chat.
+    return f"chat_context:{chat_id}:{scope}" if scope else f"chat_context:{chat_id}"
+
+def get_chat_context(chat_id: str, scope: Optional[str] = None) -> List[Dict[str, Any]]:
     if not r: return []
-    context = r.get(f"chat_context:{chat_id}")
+    context = r.get(_chat_context_key(chat_id, scope))
     return json.loads(context) if context else []
 
-def save_chat_context(chat_id: str, context: List[Dict[str, Any]]):
+def save_chat_context(chat_id: str, context: List[Dict[str, Any]], scope: Optional[str] = None):
+    if not r: return
+    r.set(_chat_context_key(chat_id, scope), json.dumps(context), ex=7200)
+
+def _chat_memory_keys(chat_id: str) -> Dict[str, str]:
+    base = f"chat_memory:{chat_id}"
+    return {"seq": f"{base}:seq", "items": f"{base}:items", "vectors": f"{base}:vectors", "last_used": f"{base}:last_used"}
+
+def add_chat_memory_item(chat_id: str, item: Dict[str, Any], vector: str, max_items: int, ttl_seconds: int):
+    """Adds one memory item and evicts the least recently used ones beyond `max_items`, without rewriting the others."""
+    if not r: return
+    keys = _chat_memory_keys(chat_id)
+    item_id = r.incr(keys["seq"])
+    pipe = r.pipeline()
+    pipe.hset(keys["items"], item_id, json.dumps(item))
+    pipe.hset(keys["vectors"], item_id, vector)
+    pipe.zadd(keys["last_used"], {item_id: item["created"]})
+    for key in keys.values():
+        pipe.expire(key, ttl_seconds)
+    pipe.execute()
+
+    excess = r.zcard(keys["last_used"]) - max_items
+    if excess > 0:
+        # ZPOPMIN is atomic, so concurrent workers never evict the same item twice.
+        evicted = [member for member, _ in r.zpopmin(keys["last_used"], excess)]
+        delete_chat_memory_items(chat_id, evicted)
+
+def get_chat_memory_items(chat_id: str) -> Tuple[Dict[int, Dict[str, Any]], Dict[int, str]]:
+    if not r: return {}, {}
+    keys = _chat_memory_keys(chat_id)
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(keys["items"])
+    pipe.hgetall(keys["vectors"])
+    items, vectors = pipe.execute()
+    return ({int(item_id): json.loads(item) for item_id, item in items.items()},
+            {int(item_id): vector for item_id, vector in vectors.items()})
+
+def touch_chat_memory_items(chat_id: str, item_ids: List[int], timestamp: float):
+    if not r or not item_ids: return
+    # XX keeps items that were evicted in the meantime from coming back.
+    r.zadd(_chat_memory_keys(chat_id)["last_used"], {item_id: timestamp for item_id in item_ids}, xx=True)
+
+def delete_chat_memory_items(chat_id: str, item_ids: List[int]):
+    if not r or not item_ids: return
+    keys = _chat_memory_keys(chat_id)
+    pipe = r.pipeline()
+    pipe.hdel(keys["items"], *item_ids)
+    pipe.hdel(keys["vectors"], *item_ids)
+    pipe.zrem(keys["last_used"], *item_ids)
+    pipe.execute()
+
+def clear_chat_memory(chat_id: str):
+    if not r: return
+    r.delete(*_chat_memory_keys(chat_id).values())
+
+def get_media_cache_entry(resource_key: str) -> Optional[Dict[str, Any]]:
+    if not r: return None
+    entry = r.get(f"media:{resource_key}")
+    return json.loads(entry) if entry else None
+
+def set_media_cache_entry(resource_key: str, entry: Dict[str, Any], ttl_seconds: int):
     if not r: return
-    r.set(f"chat_context:{chat_id}", json.dumps(context), ex=7200)
+    r.set(f"media:{resource_key}", json.dumps(entry), ex=ttl_seconds)
+
+USAGE_WINDOW_DAYS = 30
+
+def _usage_key(chat_id: str, day: date) -> str:
+    return f"usage:{chat_id}:{day:%Y%m%d}"
+
+def record_chat_usage(chat_id: str, usage: Dict[str, int]):
+    if not r: return
+    # One bucket per UTC day, so that reads can sum exactly the last USAGE_WINDOW_DAYS days.
+    key = _usage_key(chat_id, datetime.now(timezone.utc).date())
+    pipe = r.pipeline()
+    for field, amount in usage.items():
+        pipe.hincrby(key, field, amount)
+    pipe.expire(key, (USAGE_WINDOW_DAYS + 1) * 86400)
+    pipe.execute()
+
+def get_chat_usage(chat_id: str) -> Dict[str, int]:
+    """Sums the usage buckets of the last USAGE_WINDOW_DAYS days, today included."""
+    if not r: return {}
+    today = datetime.now(timezone.utc).date()
+    pipe = r.pipeline(transaction=False)
+    for offset in range(USAGE_WINDOW_DAYS):
+        pipe.hgetall(_usage_key(chat_id, today - timedelta(days=offset)))
+    totals: Dict[str, int] = {}
+    for bucket in pipe.execute():
+        for field, value in bucket.items():
+            totals[field] = totals.get(field, 0) + int(value)
+    return totals
 
 def get_chat_settings(chat_id: str) -> Dict[str, str]:
     if not r: return {}
@@ -56,9 +149,18 @@ def set_lark_token_to_cache(token: str, expire_in: int):
 
 def clear_user_data(chat_id: str):
     if not r: return
-    r.delete(f"chat_context:{chat_id}")
+    clear_all_chat_contexts(chat_id)
     r.delete(f"settings:{chat_id}")
+    clear_chat_memory(chat_id)
+
+def clear_chat_context(chat_id: str, scope: Optional[str] = None):
+    if not r: return
+    r.delete(_chat_context_key(chat_id, scope))
 
-def clear_chat_context(chat_id: str):
+def clear_all_chat_contexts(chat_id: str):
+    """Deletes the chat-level context along with every thread/sender scoped context of the chat."""
     if not r: return
-    r.delete(f"chat_context:{chat_id}")
+    r.delete(_chat_context_key(chat_id))
+    scoped_keys = list(r.scan_iter(match=f"{_chat_context_key(chat_id)}:*", count=500))
+    if scoped_keys:
+        r.delete(*scoped_keys)